@@ -1,27 +1,37 @@
 """The new version of graphs."""
 from __future__ import annotations
-from typing import Optional, Any, TextIO
-from collections import deque
-from queue_utils import PriorityQueue
+from typing import BinaryIO, Iterable, Optional, TextIO
+from collections import OrderedDict, deque
+from collections.abc import Iterator, Mapping
+import heapq
+import math
+import numpy as np
 import folium
 
+_EARTH_RADIUS = 6371008.8  # The mean radius of the earth in metres.
+PATH_CACHE_SIZE = 1024  # The number of most recent results kept by Graph.find_shortest_path.
+SOURCE_TREE_CACHE_SIZE = 32  # The number of most recently used shortest path trees kept by a Graph.
+NPZ_FORMAT_VERSION = 2  # Increase this whenever the layout written by Graph.write_graph_npz changes.
+_ROAD_CLASS_BITS: dict[str, int] = {}  # The bit of each road class seen so far in road class masks.
+
 
 class _Vertex:
     """A vertex representing a junction"""
+    __slots__ = ('junc_id', 'upstream', 'downstream', 'coordinates', 'message')
     junc_id: int
-    upstream: set[_Vertex]
-    downstream: set[_Vertex]
-    coordinates: list[int | float]
+    upstream: list[_Vertex]
+    downstream: list[_Vertex]
+    coordinates: np.ndarray
     message: str
 
     def __init__(self, junc_id: int, coord: list[int | float], message: str = '') -> None:
         self.junc_id = junc_id
-        self.coordinates = coord
-        self.upstream = set()
-        self.downstream = set()
+        self.coordinates = np.array(coord, dtype=np.float64)
+        self.upstream = []
+        self.downstream = []
         self.message = message
 
-    def get_coordinates(self) -> list[int | float]:
+    def get_coordinates(self) -> np.ndarray:
         """Return the coordinates of the junction."""
         return self.coordinates.copy()
 
@@ -42,24 +52,46 @@ class _Edge:
     """An edge representing a road.
 
     Representation Invariants:
-        - 'distance' in self.info
-        - 'travel_time' in self.info
+        - self.distance >= 0
+        - self.travel_time >= 0
+        - self.ogf_ids is a sorted int64 array with no duplicates
+        - self.class_mask == _road_classes_mask({segment.road_class for segment in self.segments})
     """
+    __slots__ = ('start_id', 'end_id', 'ogf_ids', 'segments', 'distance', 'travel_time', 'class_mask',
+                 '_polylines_cache')
     start_id: int
     end_id: int
-    ogf_ids: set[int]
+    ogf_ids: np.ndarray
     segments: set[_Segment]
-    info: dict[str, Any]
+    distance: float
+    travel_time: float
+    class_mask: int
+    _polylines_cache: Optional[set[folium.PolyLine]]
+
+    def __init__(self, start_id: int, end_id: int, ogf_ids: np.ndarray, length: float,
+                 segments: Optional[set[_Segment]] = None, travel_time: Optional[float] = None) -> None:
+        """Initialize a new edge.
+        If travel_time is given, it is used as the travel time of the edge instead of summing it over segments.
 
-    def __init__(self, start_id: int, end_id: int, ogf_ids: set[int], length: float,
-                 segments: Optional[set[_Segment]] = None) -> None:
+        Preconditions:
+            - travel_time is None or segments is not None
+            - travel_time is None or the travel time of segments is travel_time
+        """
         self.start_id = start_id
         self.end_id = end_id
         self.ogf_ids = ogf_ids
-        self.info = {'distance': length, 'travel_time': 0.0}
+        self.distance = length
+        self.travel_time = 0.0
+        self._polylines_cache = None
+        self.class_mask = 0
         if segments is not None:
             self.segments = segments
-            self.update_travel_time()
+            for segment in segments:
+                self.class_mask |= segment.road_class_bit
+            if travel_time is not None:
+                self.travel_time = travel_time
+            else:
+                self.update_travel_time()
         else:
             self.segments = set()
 
@@ -69,30 +101,46 @@ class _Edge:
         total_time = 0.0
         for segment in self.segments:
             total_time += segment.seg_length / (segment.speed_limit * 1e3)
-        self.info['travel_time'] = total_time
+        self.travel_time = total_time
+
+    def weight(self, weight_type: str) -> float:
+        """Return the weight of this edge of type weight_type.
+
+        Preconditions:
+            - weight_type in {'distance', 'travel_time'}
+        """
+        return self.distance if weight_type == 'distance' else self.travel_time
 
     def add_segment(self, segment: _Segment) -> None:
         """Add a segment to this edge."""
-        if segment.corr_ogfid in self.ogf_ids:
+        i = np.searchsorted(self.ogf_ids, segment.corr_ogfid)
+        if i < len(self.ogf_ids) and self.ogf_ids[i] == segment.corr_ogfid:
             self.segments.add(segment)
+            self._polylines_cache = None
+            self.class_mask |= segment.road_class_bit
 
     def get_polylines(self) -> set[folium.PolyLine]:
-        """Return a set of polylines of the segments in this edge."""
-        return {folium.PolyLine(locations=segment.coordinates,
-                                popup=f"name: {segment.name};\n"
-                                      f"length: {round(segment.seg_length / 1e3, 3)}km;\n"
-                                      f"road class: {segment.road_class};\n"
-                                      f"speed limit: {segment.speed_limit}km/h") for segment in self.segments}
+        """Return a set of polylines of the segments in this edge.
+        The polylines are built on the first call and reused until a segment is added.
+        """
+        if self._polylines_cache is None:
+            self._polylines_cache = {folium.PolyLine(locations=segment.coordinates.tolist(),
+                                                     popup=f"name: {segment.name};\n"
+                                                           f"length: {segment.length_km}km;\n"
+                                                           f"road class: {segment.road_class};\n"
+                                                           f"speed limit: {segment.speed_limit}km/h")
+                                     for segment in self.segments}
+        return self._polylines_cache
 
     def all_in_road_classes(self, road_classes: set[str]) -> bool:
         """Determine if all segments in the edge belongs to one road class in road_classes.
         """
-        return all(segment.road_class in road_classes for segment in self.segments)
+        return (self.class_mask & ~_road_classes_mask(road_classes)) == 0
 
     def any_in_road_classes(self, road_classes: set[str]) -> bool:
         """Determine if any segments in the edge belongs to one road class in road_classes.
         """
-        return any(segment.road_class in road_classes for segment in self.segments)
+        return (self.class_mask & _road_classes_mask(road_classes)) != 0
 
 
 class _Segment:
@@ -100,32 +148,69 @@ class _Segment:
 
     Representation Invariants:
         - self.length > 0
+        - self.coordinates.ndim == 2 and self.coordinates.shape[1] == 2
     """
+    __slots__ = ('corr_ogfid', 'name', 'seg_length', 'length_km', 'road_class', 'road_class_bit', 'speed_limit',
+                 'coordinates')
     corr_ogfid: int
     name: str
     seg_length: float
+    length_km: float
     road_class: str
+    road_class_bit: int
     speed_limit: int
-    coordinates: list[list[float]]
+    coordinates: np.ndarray
 
     def __init__(self, ogfid: int, length: float, road_class: str, speed_limit: int,
-                 coordinates: list[list[int | float]], name: str = '') -> None:
+                 coordinates: list[list[int | float]] | np.ndarray, name: str = '') -> None:
         self.corr_ogfid = ogfid
         self.name = name
         self.seg_length = length
+        self.length_km = round(length / 1e3, 3)
         self.road_class = road_class
+        self.road_class_bit = _ROAD_CLASS_BITS.setdefault(road_class, 1 << len(_ROAD_CLASS_BITS))
         self.speed_limit = speed_limit
-        self.coordinates = coordinates
+        self.coordinates = np.asarray(coordinates, dtype=np.float64)
 
 
 class Graph:
-    """The graph representing a road network."""
+    """The graph representing a road network.
+
+    Besides the vertex and edge objects, the graph keeps a compressed sparse row (CSR) snapshot of its
+    adjacency for traversals. Vertices are numbered by their position (iloc) in self._node_ids and edges by their
+    position in self._edge_list. The neighbours of the vertex with iloc i are
+    self._out_neighbors[self._out_indptr[i]:self._out_indptr[i + 1]], and the corresponding entries of
+    self._out_edge_iloc are the ilocs of the edges leading to them (and symmetrically for self._in_*).
+    The snapshot is rebuilt lazily on the first traversal after the graph is mutated.
+    """
     _vertices: dict[int, _Vertex]
     _edges: dict[tuple[int, int], _Edge]
+    _csr_dirty: bool
+    _node_ids: np.ndarray
+    _node_id_list: list[int]
+    _node_iloc: dict[int, int]
+    _edge_list: list[_Edge]
+    _out_indptr: np.ndarray
+    _out_neighbors: np.ndarray
+    _out_edge_iloc: np.ndarray
+    _in_indptr: np.ndarray
+    _in_neighbors: np.ndarray
+    _in_edge_iloc: np.ndarray
+    _edge_src: np.ndarray
+    _edge_dst: np.ndarray
+    _edge_dist: np.ndarray
+    _edge_time: np.ndarray
+    _node_coords: np.ndarray
+    _heuristic_scales: dict[str, float]
+    _csr_lists: dict[tuple[str, str], tuple[list[int], list[int], list[float]]]
+    _path_cache: OrderedDict[tuple[int, int, str, str], Optional[tuple[list[int], float]]]
+    _source_trees: OrderedDict[tuple[int, str], tuple[np.ndarray, np.ndarray]]
+    _weak_labels: Optional[list[int]]
 
     def __init__(self) -> None:
         self._vertices = {}
         self._edges = {}
+        self._csr_dirty = True
 
     def __contains__(self, item: int | tuple[int, int]) -> bool:
         if isinstance(item, int):
@@ -139,8 +224,18 @@ class Graph:
         """Add a vertex to the graph. Do nothing if it already exists."""
         if junc_id not in self._vertices:
             self._vertices[junc_id] = _Vertex(junc_id, coord, message)
+            self._csr_dirty = True
+
+    def add_vertices(self, coords: Mapping[int, list[int | float] | np.ndarray]) -> None:
+        """Add a vertex at coords[junc_id] for every junc_id in coords, in the order of coords.
+        Ids that already belong to a vertex of the graph are skipped.
+        """
+        vertices = self._vertices
+        vertices.update({junc_id: _Vertex(junc_id, coord) for junc_id, coord in coords.items()
+                         if junc_id not in vertices})
+        self._csr_dirty = True
 
-    def get_vertex_coordinates(self, junc_id: int) -> list[int | float]:
+    def get_vertex_coordinates(self, junc_id: int) -> np.ndarray:
         """Get the coordinates of the vertex with junc_id.
         Raise ValueError if junc_id is not in self._vertices.
         """
@@ -150,33 +245,81 @@ class Graph:
             raise ValueError
 
     def add_edge_with_segments(self, start_id: int, end_id: int, ogf_ids: set[int],
-                               length: float, weight_type: str, segments_info: list[tuple]) -> None:
+                               length: float, weight_type: str, segments_info: list[tuple],
+                               travel_time: Optional[float] = None) -> None:
         """Add an edge containing segments with properties given by segments_info into the graph.
         If an edge already exists from start_id to end_id, replace it if the new edge has a lower weight of type
         weight_type and do nothing otherwise.
+        travel_time may be passed if the travel time of the segments is already known.
         Raise ValueError if start_id not in self._vertices or end_id not in self._vertices.
 
         Preconditions:
             - all(seg_info[0] in ogf_ids for seg_info in segments_info)
             - weight_type in {"distance", "travel_time"}
+            - travel_time is None or travel_time is the total travel time of the segments in segments_info
         """
         if start_id in self._vertices and end_id in self._vertices:
             segments = set()
             for ogf_id, seg_len, rc, speed_lim, coordinates, road_name in segments_info:
                 segments.add(_Segment(ogf_id, seg_len, rc, speed_lim,
                                       coordinates, road_name))
-            new_edge = _Edge(start_id, end_id, ogf_ids, length, segments)
-            if (start_id, end_id) not in self._edges:
-                u = self._vertices[start_id]
-                v = self._vertices[end_id]
-                u.downstream.add(v)
-                v.upstream.add(u)
-                self._edges[(start_id, end_id)] = new_edge
-            elif self._edges[(start_id, end_id)].info[weight_type] > new_edge.info[weight_type]:
-                self._edges[(start_id, end_id)] = new_edge
+            self._add_edge(_Edge(start_id, end_id, np.array(sorted(ogf_ids), dtype=np.int64), length, segments,
+                                 travel_time), weight_type)
         else:
             raise ValueError
 
+    def add_edge_with_segment_arrays(self, start_id: int, end_id: int, ogf_ids: set[int], length: float,
+                                     weight_type: str, seg_ogfids: np.ndarray, seg_lengths: np.ndarray,
+                                     seg_road_classes: list[str], seg_speed_limits: list[int],
+                                     seg_coords: list[np.ndarray], seg_names: list[str],
+                                     travel_time: Optional[float] = None, two_way: bool = False) -> None:
+        """Add an edge into the graph like self.add_edge_with_segments, with the properties of its segments given
+        column by column instead of as one tuple per segment.
+        If travel_time is not given, it is computed from the lengths and speed limits of the segments.
+        If two_way is True, also add the edge from end_id to start_id, which shares the segment objects of the
+        edge from start_id to end_id.
+        Raise ValueError if start_id not in self._vertices or end_id not in self._vertices.
+
+        Preconditions:
+            - len(seg_ogfids) == len(seg_lengths) == len(seg_road_classes) == len(seg_speed_limits)
+              == len(seg_coords) == len(seg_names)
+            - all(ogf_id in ogf_ids for ogf_id in seg_ogfids)
+            - weight_type in {"distance", "travel_time"}
+            - travel_time is None or travel_time is the total travel time of the segments
+        """
+        if start_id in self._vertices and end_id in self._vertices:
+            if travel_time is None:
+                travel_time = float(np.sum(seg_lengths / (np.array(seg_speed_limits, dtype=np.float64) * 1e3)))
+            segments = set(map(_Segment, seg_ogfids.tolist(), seg_lengths.tolist(), seg_road_classes,
+                               seg_speed_limits, seg_coords, seg_names))
+            ogf_id_arr = np.array(sorted(ogf_ids), dtype=np.int64)
+            self._add_edge(_Edge(start_id, end_id, ogf_id_arr, length, segments, travel_time), weight_type)
+            if two_way:
+                self._add_edge(_Edge(end_id, start_id, ogf_id_arr.copy(), length, set(segments), travel_time),
+                               weight_type)
+        else:
+            raise ValueError
+
+    def _add_edge(self, new_edge: _Edge, weight_type: str) -> None:
+        """Add new_edge into the graph.
+        If an edge already exists between the same vertices, replace it if new_edge has a lower weight of type
+        weight_type and do nothing otherwise.
+
+        Preconditions:
+            - new_edge.start_id in self._vertices and new_edge.end_id in self._vertices
+        """
+        start_id, end_id = new_edge.start_id, new_edge.end_id
+        if (start_id, end_id) not in self._edges:
+            u = self._vertices[start_id]
+            v = self._vertices[end_id]
+            u.downstream.append(v)
+            v.upstream.append(u)
+            self._edges[(start_id, end_id)] = new_edge
+            self._csr_dirty = True
+        elif self._edges[(start_id, end_id)].weight(weight_type) > new_edge.weight(weight_type):
+            self._edges[(start_id, end_id)] = new_edge
+            self._csr_dirty = True
+
     def add_message_to_vertices(self, messages: dict[int, str]) -> None:
         """Add messages to certain vertices"""
         for junc_id in messages:
@@ -195,7 +338,7 @@ class Graph:
         Raise ValueError if (start_id, end_id) is not in self._edges.
         """
         if (start_id, end_id) in self._edges:
-            return self._edges[(start_id, end_id)].info[weight_type]
+            return self._edges[(start_id, end_id)].weight(weight_type)
         else:
             raise ValueError
 
@@ -209,217 +352,460 @@ class Graph:
             u.downstream.remove(v)
             v.upstream.remove(u)
             self._edges.pop((start_id, end_id))
+            self._csr_dirty = True
+
+    def _build_csr(self) -> None:
+        """Rebuild the CSR snapshot of the adjacency if the graph was mutated since it was last built."""
+        if not self._csr_dirty:
+            return
+        node_ids = list(self._vertices)
+        node_iloc = {junc_id: i for i, junc_id in enumerate(node_ids)}
+        edge_list = list(self._edges.values())
+        n, m = len(node_ids), len(edge_list)
+        src = np.fromiter((node_iloc[edge.start_id] for edge in edge_list), dtype=np.int32, count=m)
+        dst = np.fromiter((node_iloc[edge.end_id] for edge in edge_list), dtype=np.int32, count=m)
+        bounds = np.arange(n + 1)
+
+        out_order = np.argsort(src, kind='stable').astype(np.int32)
+        self._out_indptr = np.searchsorted(src[out_order], bounds).astype(np.int32)
+        self._out_neighbors = dst[out_order]
+        self._out_edge_iloc = out_order
+
+        in_order = np.argsort(dst, kind='stable').astype(np.int32)
+        self._in_indptr = np.searchsorted(dst[in_order], bounds).astype(np.int32)
+        self._in_neighbors = src[in_order]
+        self._in_edge_iloc = in_order
+
+        self._edge_src = src
+        self._edge_dst = dst
+        self._edge_dist = np.fromiter((edge.distance for edge in edge_list), dtype=np.float64, count=m)
+        self._edge_time = np.fromiter((edge.travel_time for edge in edge_list), dtype=np.float64, count=m)
+        self._node_ids = np.array(node_ids, dtype=np.int64)
+        self._node_id_list = node_ids
+        self._node_coords = np.array([vertex.coordinates for vertex in self._vertices.values()],
+                                     dtype=np.float64).reshape(n, 2)
+        self._heuristic_scales = {}
+        self._csr_lists = {}
+        self._path_cache = OrderedDict()
+        self._source_trees = OrderedDict()
+        self._weak_labels = None
+        self._node_iloc = node_iloc
+        self._edge_list = edge_list
+        self._csr_dirty = False
 
     def prune_graph(self, protected_ids: set[int], pruned_classes: set[str]) -> None:
         """Improved version of pruning the graph."""
-        preserved_equiv_classes = self.get_preserved_equiv_classes(protected_ids, pruned_classes)
-        potentially_pruned_equiv_classes = self.get_pruned_equiv_classes(pruned_classes)
-        to_prune = set()
-        for pruned_equiv_class in potentially_pruned_equiv_classes:
-            count = 0
-            for preserved_equiv_class in preserved_equiv_classes:
-                if not pruned_equiv_class.isdisjoint(preserved_equiv_class):
-                    count += 1
-            if count <= 1:
-                to_prune.update(pruned_equiv_class)
-        edges = self._edges.copy()
-        for start_id, end_id in edges:
-            if start_id in to_prune and end_id in to_prune and (start_id, end_id) in self._edges and \
-                    self._edges[(start_id, end_id)].all_in_road_classes(pruned_classes):
-                self.remove_edge(start_id, end_id)
-
-    def get_preserved_equiv_classes(self, protected_ids: set[int], pruned_classes: set[str]) -> list[set[int]]:
+        all_in_pruned = self._all_in_road_classes_mask(pruned_classes)
+        preserved_labels = self._preserved_class_labels(protected_ids, all_in_pruned)
+        pruned_labels = self._pruned_class_labels(all_in_pruned)
+        # For every pruned equivalence class, count the preserved equivalence classes it intersects.
+        in_preserved = preserved_labels >= 0
+        touching = np.unique(np.stack([pruned_labels[in_preserved], preserved_labels[in_preserved]]), axis=1)
+        count = np.bincount(touching[0], minlength=len(pruned_labels))
+        to_prune = count[pruned_labels] <= 1
+        edge_list = self._edge_list
+        to_remove = all_in_pruned & to_prune[self._edge_src] & to_prune[self._edge_dst]
+        for i in np.flatnonzero(to_remove).tolist():
+            self.remove_edge(edge_list[i].start_id, edge_list[i].end_id)
+
+    def _all_in_road_classes_mask(self, road_classes: set[str]) -> np.ndarray:
+        """Return a boolean array whose entry at each edge iloc is whether all segments in that edge belong to
+        one road class in road_classes.
+        """
+        self._build_csr()
+        other_classes = ~_road_classes_mask(road_classes)
+        return np.fromiter(((edge.class_mask & other_classes) == 0 for edge in self._edge_list),
+                           dtype=np.bool_, count=len(self._edge_list))
+
+    def get_preserved_equiv_classes(self, protected_ids: set[int], pruned_classes: set[str],
+                                    all_in_pruned: Optional[np.ndarray] = None) -> list[set[int]]:
         """Return a list of sets of vertex ids satisfying the following properties:
             - For every 2 sets in the returned list, they are disjoint.
             - For every ordered pair (u, v) of vertices such that u.junc_id and v.junc_id are in the same set
             in the returned list, it is possible to travel from u to v AND from v to u using a path that do not use
             any road belonging to a class in pruned_classes.
             - For every id in protected_ids, id is in a set in the returned list.
+        all_in_pruned may be passed as the result of self._all_in_road_classes_mask(pruned_classes) to avoid
+        recomputing it.
         """
-        visited = set()
-        res = []
-        for k in self._vertices:
-            if k not in visited:
-                vertex = self._vertices[k]
-                to_check_downstream = deque([u.junc_id for u in vertex.downstream if
-                                             not self._edges[(k, u.junc_id)].all_in_road_classes(pruned_classes)])
-                to_check_upstream = deque([v.junc_id for v in vertex.upstream if
-                                           not self._edges[(v.junc_id, k)].all_in_road_classes(pruned_classes)])
-                if k in protected_ids or (len(to_check_upstream) > 0 and len(to_check_downstream) > 0):
-                    downstream_connected = {k}.union(set(to_check_downstream))
-                    upstream_connected = {k}.union(set(to_check_upstream))
-                    while len(to_check_downstream) > 0:
-                        u = self._vertices[to_check_downstream.popleft()]
-                        for v in u.downstream:
-                            if v.junc_id not in downstream_connected and \
-                                    not self._edges[(u.junc_id, v.junc_id)].all_in_road_classes(pruned_classes):
-                                downstream_connected.add(v.junc_id)
-                                to_check_downstream.append(v.junc_id)
-                    while len(to_check_upstream) > 0:
-                        u = self._vertices[to_check_upstream.popleft()]
-                        for v in u.upstream:
-                            if v.junc_id not in upstream_connected and \
-                                    not self._edges[(v.junc_id, u.junc_id)].all_in_road_classes(pruned_classes):
-                                upstream_connected.add(v.junc_id)
-                                to_check_upstream.append(v.junc_id)
-                    equivalence_class = downstream_connected.intersection(upstream_connected)
-                    visited.update(equivalence_class)
-                    res.append(equivalence_class)
-        return res
-
-    def get_pruned_equiv_classes(self, pruned_classes: set[str]) -> list[set[int]]:
+        if all_in_pruned is None:
+            all_in_pruned = self._all_in_road_classes_mask(pruned_classes)
+        labels = self._preserved_class_labels(protected_ids, all_in_pruned)
+        return _group_by_label(self._node_ids, labels, 1)
+
+    def get_pruned_equiv_classes(self, pruned_classes: set[str],
+                                 all_in_pruned: Optional[np.ndarray] = None) -> list[set[int]]:
         """Return a list of sets of vertex ids satisfying the following properties:
             - For any 2 sets in the returned list, they are disjoint.
             - For any pair of ordered pair of vertices (u, v) such that u.junc_id and v.junc_id are in the same
             set in the returned list, they are connected by roads belonging to pruned classes in an undirected sense.
             (i.e. It would be possible to travel from u to v AND from v to u along a route that only
             uses roads belonging to pruned classes if every road in the network permits traffic in both directions.)
+        all_in_pruned may be passed as the result of self._all_in_road_classes_mask(pruned_classes) to avoid
+        recomputing it.
+        """
+        if all_in_pruned is None:
+            all_in_pruned = self._all_in_road_classes_mask(pruned_classes)
+        labels = self._pruned_class_labels(all_in_pruned)
+        return _group_by_label(self._node_ids, labels, 2)
+
+    def _preserved_class_labels(self, protected_ids: set[int], all_in_pruned: np.ndarray) -> np.ndarray:
+        """Return an array mapping each vertex iloc to the label of its preserved equivalence class, or -1 if
+        the vertex is in none (see get_preserved_equiv_classes).
+
+        The classes are the strongly connected components of the subgraph of edges that are not all in the
+        pruned classes, found in a single pass with an iterative version of Tarjan's algorithm. A component
+        consisting of a single vertex is kept only if the vertex is protected or has both an incoming and an
+        outgoing edge in that subgraph.
+
+        Preconditions:
+            - all_in_pruned is the result of self._all_in_road_classes_mask for the current graph
+        """
+        node_ids = self._node_id_list
+        out_indptr, out_neighbors = self._out_indptr.tolist(), self._out_neighbors.tolist()
+        out_pruned = all_in_pruned[self._out_edge_iloc].tolist()
+        n = len(node_ids)
+        kept_in = np.bincount(self._edge_dst[~all_in_pruned], minlength=n) > 0
+        kept_out = np.bincount(self._edge_src[~all_in_pruned], minlength=n) > 0
+        qualified = (kept_in & kept_out).tolist()
+        index = [-1] * n
+        low = [0] * n
+        on_stack = bytearray(n)
+        labels = [-1] * n
+        stack = []
+        counter = 0
+        label_count = 0
+        for root in range(n):
+            if index[root] == -1:
+                index[root] = low[root] = counter
+                counter += 1
+                stack.append(root)
+                on_stack[root] = True
+                work = [(root, out_indptr[root])]
+                while len(work) > 0:
+                    u, i = work[-1]
+                    end = out_indptr[u + 1]
+                    while i < end and out_pruned[i]:
+                        i += 1
+                    if i < end:
+                        work[-1] = (u, i + 1)
+                        v = out_neighbors[i]
+                        if index[v] == -1:
+                            index[v] = low[v] = counter
+                            counter += 1
+                            stack.append(v)
+                            on_stack[v] = True
+                            work.append((v, out_indptr[v]))
+                        elif on_stack[v] and index[v] < low[u]:
+                            low[u] = index[v]
+                    else:
+                        work.pop()
+                        if low[u] == index[u]:
+                            w = stack.pop()
+                            on_stack[w] = False
+                            if w != u or qualified[u] or node_ids[u] in protected_ids:
+                                labels[w] = label_count
+                                while w != u:
+                                    w = stack.pop()
+                                    on_stack[w] = False
+                                    labels[w] = label_count
+                                label_count += 1
+                        if len(work) > 0 and low[u] < low[work[-1][0]]:
+                            low[work[-1][0]] = low[u]
+        return np.array(labels, dtype=np.int32)
+
+    def _pruned_class_labels(self, all_in_pruned: np.ndarray) -> np.ndarray:
+        """Return an array mapping each vertex iloc to the label of its pruned equivalence class (see
+        get_pruned_equiv_classes), computed with union-find over the edges that are all in the pruned classes.
+        Vertices that do not belong to any pruned equivalence class get a label of their own.
+
+        Preconditions:
+            - all_in_pruned is the result of self._all_in_road_classes_mask for the current graph
         """
-        visited = set()
-        res = []
-        for k in self._vertices:
-            if k not in visited:
-                vertex = self._vertices[k]
-                adjacent = vertex.upstream.union(vertex.downstream)
-                to_check = deque([u.junc_id for u in adjacent if
-                                  ((k, u.junc_id) in self._edges and
-                                   self._edges[(k, u.junc_id)].all_in_road_classes(pruned_classes)) or
-                                  ((u.junc_id, k) in self._edges and
-                                   self._edges[(u.junc_id, k)].all_in_road_classes(pruned_classes))])
-                if len(to_check) > 0:
-                    equivalence_class = {k}.union(set(to_check))
-                    while len(to_check) > 0:
-                        u = self._vertices[to_check.popleft()]
-                        cur_adjacent = u.upstream.union(u.downstream)
-                        for v in cur_adjacent:
-                            if v.junc_id not in equivalence_class:
-                                if ((u.junc_id, v.junc_id) in self._edges and
-                                    self._edges[(u.junc_id, v.junc_id)].all_in_road_classes(pruned_classes)) or \
-                                        ((v.junc_id, u.junc_id) in self._edges and
-                                         self._edges[(v.junc_id, u.junc_id)].all_in_road_classes(pruned_classes)):
-                                    equivalence_class.add(v.junc_id)
-                                    to_check.append(v.junc_id)
-                    visited.update(equivalence_class)
-                    res.append(equivalence_class)
-        return res
+        return np.array(_union_find_labels(len(self._node_ids), self._edge_src[all_in_pruned].tolist(),
+                                           self._edge_dst[all_in_pruned].tolist()), dtype=np.int32)
+
+    def _weak_component_labels(self) -> list[int]:
+        """Return a list mapping each vertex iloc to the label of its weakly connected component, so that two
+        vertices with different labels are never connected by a path.
+        The labels are computed once per CSR snapshot.
+        """
+        self._build_csr()
+        if self._weak_labels is None:
+            self._weak_labels = _union_find_labels(len(self._node_ids), self._edge_src.tolist(),
+                                                   self._edge_dst.tolist())
+        return self._weak_labels
 
     def remove_redundant_vertices(self, weight_type: str, protected_ids: set[int]) -> None:
         """After pruning, since certain roads are removed, there will be some vertices
         that simply acts as a point on a non-branching road. It's desirable to remove a vertex
         of this kind and connect the 2 edges separated by the vertex into a single continuous edge.
+        Every maximal chain of such vertices is collapsed at once, so each road is merged into a single edge
+        in one step.
+
+        Preconditions:
+            - weight_type in {'distance', 'travel_time'}
+        """
+        self._csr_dirty = True
+        verts = self._vertices
+        worklist = deque(vertex for vertex in verts.values() if vertex.junc_id not in protected_ids)
+        in_worklist = set(worklist)
+        while len(worklist) > 0:
+            vertex = worklist.popleft()
+            in_worklist.remove(vertex)
+            if verts.get(vertex.junc_id) is not vertex:
+                continue  # The vertex was removed as part of a chain collapsed earlier.
+            link_kind = _link_kind(vertex, protected_ids)
+            spliced_neighbors = ()
+            if len(vertex.upstream) == 0 and len(vertex.downstream) == 0:
+                verts.pop(vertex.junc_id)
+            elif link_kind != 0:
+                path = _chain_through(vertex, link_kind, protected_ids)
+                self._merge_path(path, weight_type)
+                if link_kind == 2:
+                    self._merge_path(path[::-1], weight_type)
+                for link in path[1:-1]:
+                    verts.pop(link.junc_id)
+                spliced_neighbors = (path[0], path[-1])
+            for neighbor in spliced_neighbors:
+                if neighbor not in in_worklist and neighbor.junc_id not in protected_ids:
+                    worklist.append(neighbor)
+                    in_worklist.add(neighbor)
+
+    def _merge_path(self, path: list[_Vertex], weight_type: str) -> None:
+        """Replace the edges along path with a single edge from its first to its last vertex.
+        If an edge between them already exists, keep whichever of the two has the lower weight of type weight_type.
 
         Preconditions:
+            - len(path) >= 3
+            - all((path[i].junc_id, path[i + 1].junc_id) in self._edges for i in range(len(path) - 1))
+            - path[0] is not path[-1]
             - weight_type in {'distance', 'travel_time'}
         """
-        vertices = set(self._vertices.values())
-        for vertex in vertices:
-            if vertex.junc_id in self._vertices and vertex.junc_id not in protected_ids:
-                if vertex.in_degree() == 0 and vertex.out_degree() == 0:
-                    self._vertices.pop(vertex.junc_id)
-                elif vertex.in_degree() == 1 and vertex.out_degree() == 1 and vertex.upstream != vertex.downstream:
-                    self._vertices.pop(vertex.junc_id)
-                    v1 = vertex.upstream.pop()
-                    v2 = vertex.downstream.pop()
-                    v1.downstream.remove(vertex)
-                    v2.upstream.remove(vertex)
-                    in_edge = self._edges[(v1.junc_id, vertex.junc_id)]
-                    out_edge = self._edges[(vertex.junc_id, v2.junc_id)]
-                    if (v1.junc_id, v2.junc_id) not in self._edges or \
-                            self._edges[(v1.junc_id, v2.junc_id)].info[weight_type] > \
-                            in_edge.info[weight_type] + out_edge.info[weight_type]:
-                        new_edge = _Edge(v1.junc_id, v2.junc_id, in_edge.ogf_ids.union(out_edge.ogf_ids),
-                                         in_edge.info['distance'] + out_edge.info['distance'],
-                                         in_edge.segments.union(out_edge.segments))
-                        self._edges[(v1.junc_id, v2.junc_id)] = new_edge
-                    v1.downstream.add(v2)
-                    v2.upstream.add(v1)
-                    self._edges.pop((v1.junc_id, vertex.junc_id))
-                    self._edges.pop((vertex.junc_id, v2.junc_id))
-                elif vertex.in_degree() == 2 and vertex.out_degree() == 2 and vertex.upstream == vertex.downstream:
-                    self._vertices.pop(vertex.junc_id)
-                    v1 = vertex.downstream.pop()
-                    v2 = vertex.downstream.pop()
-                    vertex.upstream.clear()
-                    v1.downstream.remove(vertex)
-                    v1.upstream.remove(vertex)
-                    v2.downstream.remove(vertex)
-                    v2.upstream.remove(vertex)
-                    e1 = self._edges[(v1.junc_id, vertex.junc_id)]
-                    e2 = self._edges[(vertex.junc_id, v2.junc_id)]
-                    e3 = self._edges[(v2.junc_id, vertex.junc_id)]
-                    e4 = self._edges[(vertex.junc_id, v1.junc_id)]
-                    if (v1.junc_id, v2.junc_id) not in self._edges or \
-                            self._edges[(v1.junc_id, v2.junc_id)].info[weight_type] > \
-                            e1.info[weight_type] + e2.info[weight_type]:
-                        new_edge1 = _Edge(v1.junc_id, v2.junc_id, e1.ogf_ids.union(e2.ogf_ids),
-                                          e1.info['distance'] + e2.info['distance'],
-                                          e1.segments.union(e2.segments))
-                        self._edges[(v1.junc_id, v2.junc_id)] = new_edge1
-                    v1.downstream.add(v2)
-                    v2.upstream.add(v1)
-                    self._edges.pop((v1.junc_id, vertex.junc_id))
-                    self._edges.pop((vertex.junc_id, v2.junc_id))
-                    if (v2.junc_id, v1.junc_id) not in self._edges or \
-                            self._edges[(v2.junc_id, v1.junc_id)].info[weight_type] > \
-                            e3.info[weight_type] + e4.info[weight_type]:
-                        new_edge2 = _Edge(v2.junc_id, v1.junc_id, e3.ogf_ids.union(e4.ogf_ids),
-                                          e3.info['distance'] + e4.info['distance'],
-                                          e3.segments.union(e4.segments))
-                        self._edges[(v2.junc_id, v1.junc_id)] = new_edge2
-                    v2.downstream.add(v1)
-                    v1.upstream.add(v2)
-                    self._edges.pop((v2.junc_id, vertex.junc_id))
-                    self._edges.pop((vertex.junc_id, v1.junc_id))
-
-    def find_shortest_path(self, start_id: int, end_id: int, weight_type: str) -> Optional[tuple[list[int], float]]:
-        """Find the shortest path from start_id to end_id using Dijkstra's algorithm.
+        edges = self._edges
+        merged_edges = []
+        for u, v in zip(path, path[1:]):
+            u.downstream.remove(v)
+            v.upstream.remove(u)
+            merged_edges.append(edges.pop((u.junc_id, v.junc_id)))
+        start, end = path[0], path[-1]
+        key = (start.junc_id, end.junc_id)
+        distance = sum(edge.distance for edge in merged_edges)
+        # The segments of the merged edges are disjoint, so their travel times add up.
+        travel_time = sum(edge.travel_time for edge in merged_edges)
+        existing_edge = edges.get(key)
+        if existing_edge is None:
+            start.downstream.append(end)
+            end.upstream.append(start)
+        if existing_edge is None or \
+                existing_edge.weight(weight_type) > (distance if weight_type == 'distance' else travel_time):
+            edges[key] = _Edge(key[0], key[1], np.unique(np.concatenate([edge.ogf_ids for edge in merged_edges])),
+                               distance, set().union(*(edge.segments for edge in merged_edges)), travel_time)
+
+    def find_shortest_path(self, start_id: int, end_id: int, weight_type: str,
+                           heuristic: str = 'haversine') -> Optional[tuple[list[int], float]]:
+        """Find the shortest path from start_id to end_id using A* search guided by the great-circle distance to
+        end_id, plain Dijkstra's algorithm if heuristic is 'none', or bidirectional Dijkstra's algorithm (see
+        self.find_shortest_path_bidi) if heuristic is 'bidirectional'.
+        The PATH_CACHE_SIZE most recently used results are cached until the graph is mutated, so repeated queries
+        with the same heuristic do not search again. Queries starting from a vertex passed to
+        self.precompute_shortest_paths are answered from its shortest path tree.
         Raise ValueError if start_id or end_id are not in self._vertices.
         Preconditions:
             - weight_type in {'distance', 'travel_time'}
+            - heuristic in {'none', 'haversine', 'bidirectional'}
         """
         if start_id not in self._vertices or end_id not in self._vertices:
             raise ValueError
         elif start_id == end_id:
             return [start_id], 0.0
         else:
-            dist = {start_id: 0.0}
-            prev = {start_id: None}
-            q = PriorityQueue()
-            visited = set()
-            q.enqueue(self._vertices[start_id], 0.0)
-            while not q.is_empty():
-                u = q.dequeue()
-                visited.add(u)
-                if u.junc_id == end_id:
-                    break
-                for v in u.downstream:
-                    if v not in visited:
-                        cur_edge = self._edges[(u.junc_id, v.junc_id)]
-                        cur_dist = dist[u.junc_id] + cur_edge.info[weight_type]
-                        if v.junc_id not in dist or dist[v.junc_id] > cur_dist:
-                            dist[v.junc_id] = cur_dist
-                            prev[v.junc_id] = u.junc_id
-                            if v not in q:
-                                q.enqueue(v, cur_dist)
-                            else:
-                                q.update_priority(v, cur_dist)
-            if end_id not in dist:
+            self._build_csr()
+            key = (start_id, end_id, weight_type, heuristic)
+            if key in self._path_cache:
+                self._path_cache.move_to_end(key)
+            else:
+                self._path_cache[key] = self._search_shortest_path(start_id, end_id, weight_type, heuristic)
+                if len(self._path_cache) > PATH_CACHE_SIZE:
+                    self._path_cache.popitem(last=False)
+            result = self._path_cache[key]
+            if result is None:
                 return None
             else:
-                path = []
-                cur_id = end_id
-                while cur_id is not None:
-                    path.append(cur_id)
-                    cur_id = prev[cur_id]
-                path.reverse()
-                return path, dist[end_id]
+                return list(result[0]), result[1]
+
+    def _search_shortest_path(self, start_id: int, end_id: int, weight_type: str,
+                              heuristic: str) -> Optional[tuple[list[int], float]]:
+        """Search for the shortest path from start_id to end_id as described in self.find_shortest_path, without
+        looking at the cache of previous results.
+
+        Preconditions:
+            - start_id in self._vertices and end_id in self._vertices
+            - start_id != end_id
+            - weight_type in {'distance', 'travel_time'}
+            - heuristic in {'none', 'haversine', 'bidirectional'}
+        """
+        indptr, neighbors, weights = self._out_csr_lists(weight_type)
+        source, target = self._node_iloc[start_id], self._node_iloc[end_id]
+        weak_labels = self._weak_component_labels()
+        if weak_labels[source] != weak_labels[target]:
+            return None
+        elif (start_id, weight_type) in self._source_trees:
+            self._source_trees.move_to_end((start_id, weight_type))
+            dist, prev = self._source_trees[(start_id, weight_type)]
+        elif heuristic == 'bidirectional':
+            return self._search_bidirectional(source, target, weight_type)
+        elif heuristic == 'haversine':
+            potential = self._heuristic_scale(weight_type) * _haversine(self._node_coords, self._node_coords[target])
+            dist, prev = _astar(indptr, neighbors, weights, potential.tolist(), source, target)
+        else:
+            dist, prev = _dijkstra(indptr, neighbors, weights, source, target)
+        if prev[target] == -1:
+            return None
+        else:
+            return _reconstruct_path(self._node_id_list, prev, target), float(dist[target])
+
+    def precompute_shortest_paths(self, source_ids: Iterable[int], weight_type: str) -> None:
+        """Run Dijkstra's algorithm to completion from every vertex in source_ids and keep the resulting shortest
+        path trees, so that later calls to self.find_shortest_path starting from one of them only walk a tree.
+        Sources that already have a tree are skipped. Only the SOURCE_TREE_CACHE_SIZE most recently used trees are
+        kept, and all of them are discarded when the graph is mutated.
+        Raise ValueError if some id in source_ids is not in self._vertices.
+
+        Preconditions:
+            - weight_type in {'distance', 'travel_time'}
+        """
+        indptr, neighbors, weights = self._out_csr_lists(weight_type)
+        for start_id in source_ids:
+            if start_id not in self._vertices:
+                raise ValueError
+            elif (start_id, weight_type) in self._source_trees:
+                self._source_trees.move_to_end((start_id, weight_type))
+            else:
+                dist, prev = _dijkstra(indptr, neighbors, weights, self._node_iloc[start_id], -1)
+                self._source_trees[(start_id, weight_type)] = (np.array(dist, dtype=np.float64),
+                                                               np.array(prev, dtype=np.int32))
+                if len(self._source_trees) > SOURCE_TREE_CACHE_SIZE:
+                    self._source_trees.popitem(last=False)
+
+    def find_shortest_path_bidi(self, start_id: int, end_id: int,
+                                weight_type: str) -> Optional[tuple[list[int], float]]:
+        """Find the shortest path from start_id to end_id using bidirectional Dijkstra's algorithm, searching
+        forward from start_id and backward from end_id until the two searches meet.
+        Raise ValueError if start_id or end_id are not in self._vertices.
+        Preconditions:
+            - weight_type in {'distance', 'travel_time'}
+        """
+        if start_id not in self._vertices or end_id not in self._vertices:
+            raise ValueError
+        elif start_id == end_id:
+            return [start_id], 0.0
+        else:
+            self._build_csr()
+            source, target = self._node_iloc[start_id], self._node_iloc[end_id]
+            weak_labels = self._weak_component_labels()
+            if weak_labels[source] != weak_labels[target]:
+                return None
+            else:
+                return self._search_bidirectional(source, target, weight_type)
+
+    def _search_bidirectional(self, source: int, target: int, weight_type: str) -> Optional[tuple[list[int], float]]:
+        """Return the shortest path from the vertex with iloc source to the vertex with iloc target and its weight,
+        found by bidirectional Dijkstra's algorithm, or None if there is no such path.
+
+        Preconditions:
+            - source != target
+            - weight_type in {'distance', 'travel_time'}
+        """
+        best, meet, prev_f, prev_b = _bidirectional_dijkstra(self._out_csr_lists(weight_type),
+                                                             self._in_csr_lists(weight_type), source, target)
+        if meet == -1:
+            return None
+        else:
+            node_ids = self._node_id_list
+            path = _reconstruct_path(node_ids, prev_f, meet)
+            cur = prev_b[meet]
+            while cur != -1:
+                path.append(node_ids[cur])
+                cur = prev_b[cur]
+            return path, best
+
+    def find_shortest_paths(self, start_id: int, weight_type: str) -> LazyPathMap:
+        """Find the shortest paths from start_id to every vertex reachable from it using Dijkstra's algorithm.
+        Return a mapping from the id of each reachable vertex to the shortest path to it and its weight, in the
+        same form as returned by self.find_shortest_path. The paths are only built when they are looked up.
+        The shortest path tree is kept as if start_id had been passed to self.precompute_shortest_paths, so later
+        queries starting from start_id do not search again while it is among the most recently used trees.
+        Raise ValueError if start_id is not in self._vertices.
+
+        Preconditions:
+            - weight_type in {'distance', 'travel_time'}
+        """
+        if start_id not in self._vertices:
+            raise ValueError
+        else:
+            self._build_csr()
+            self.precompute_shortest_paths([start_id], weight_type)
+            dist, prev = self._source_trees[(start_id, weight_type)]
+            return LazyPathMap(self._node_id_list, self._node_iloc, dist.tolist(), prev.tolist())
+
+    def _out_csr_lists(self, weight_type: str) -> tuple[list[int], list[int], list[float]]:
+        """Return the outgoing CSR adjacency as the lists indptr, neighbors and weights, where weights[i] is
+        the weight of type weight_type of the edge leading to neighbors[i].
+        The lists are built once per CSR snapshot and must not be mutated.
+
+        Preconditions:
+            - weight_type in {'distance', 'travel_time'}
+        """
+        self._build_csr()
+        if ('out', weight_type) not in self._csr_lists:
+            edge_weights = self._edge_dist if weight_type == 'distance' else self._edge_time
+            self._csr_lists[('out', weight_type)] = (self._out_indptr.tolist(), self._out_neighbors.tolist(),
+                                                     edge_weights[self._out_edge_iloc].tolist())
+        return self._csr_lists[('out', weight_type)]
+
+    def _in_csr_lists(self, weight_type: str) -> tuple[list[int], list[int], list[float]]:
+        """Return the incoming CSR adjacency as the lists indptr, neighbors and weights, where weights[i] is
+        the weight of type weight_type of the edge coming from neighbors[i].
+        The lists are built once per CSR snapshot and must not be mutated.
+
+        Preconditions:
+            - weight_type in {'distance', 'travel_time'}
+        """
+        self._build_csr()
+        if ('in', weight_type) not in self._csr_lists:
+            edge_weights = self._edge_dist if weight_type == 'distance' else self._edge_time
+            self._csr_lists[('in', weight_type)] = (self._in_indptr.tolist(), self._in_neighbors.tolist(),
+                                                    edge_weights[self._in_edge_iloc].tolist())
+        return self._csr_lists[('in', weight_type)]
+
+    def _heuristic_scale(self, weight_type: str) -> float:
+        """Return the largest factor k such that the weight of type weight_type of every edge is at least k times
+        the great-circle distance between its endpoints, so that k times the great-circle distance to the target
+        is a consistent A* heuristic.
+
+        Preconditions:
+            - weight_type in {'distance', 'travel_time'}
+        """
+        self._build_csr()
+        if weight_type not in self._heuristic_scales:
+            edge_weights = self._edge_dist if weight_type == 'distance' else self._edge_time
+            chords = _haversine(self._node_coords[self._edge_src], self._node_coords[self._edge_dst])
+            positive = chords > 0
+            if np.any(positive):
+                self._heuristic_scales[weight_type] = float(np.min(edge_weights[positive] / chords[positive]))
+            else:
+                self._heuristic_scales[weight_type] = 0.0
+        return self._heuristic_scales[weight_type]
 
     def visualize_vertices(self, selected_vertices: set[int], file_path: str) -> folium.Map:
         """Save a map in which selected vertices are shown as markers."""
         m = folium.Map(location=[43.07880556, -79.07886111])  # The coordinates of Niagara Fall.
+        markers = folium.FeatureGroup(name='junctions')
         for junc_id in selected_vertices:
             vertex = self._vertices[junc_id]
-            m.add_child(folium.Marker(location=vertex.coordinates, popup=f"id: {junc_id}\n" + vertex.message))
+            markers.add_child(folium.Marker(location=vertex.coordinates, popup=f"id: {junc_id}\n" + vertex.message))
+        m.add_child(markers)
         m.save(file_path)
         return m
 
@@ -430,16 +816,17 @@ class Graph:
             m = existing_map
         else:
             m = folium.Map(location=[43.07880556, -79.07886111])
+        roads = folium.FeatureGroup(name='roads')
         for i in range(len(route) - 1):
-            edge = self._edges[(route[i], route[i + 1])]
-            polylines = edge.get_polylines()
-            for polyline in polylines:
-                m.add_child(polyline)
-        m.add_child(folium.Marker(location=self._vertices[route[0]].coordinates,
-                                  popup=f"id: {self._vertices[route[0]].junc_id}\n" + self._vertices[route[0]].message))
-        m.add_child(folium.Marker(location=self._vertices[route[-1]].coordinates,
-                                  popup=f"id: {self._vertices[route[-1]].junc_id}\n" +
-                                        self._vertices[route[-1]].message))
+            for polyline in self._edges[(route[i], route[i + 1])].get_polylines():
+                roads.add_child(polyline)
+        roads.add_child(folium.Marker(location=self._vertices[route[0]].coordinates,
+                                      popup=f"id: {self._vertices[route[0]].junc_id}\n" +
+                                            self._vertices[route[0]].message))
+        roads.add_child(folium.Marker(location=self._vertices[route[-1]].coordinates,
+                                      popup=f"id: {self._vertices[route[-1]].junc_id}\n" +
+                                            self._vertices[route[-1]].message))
+        m.add_child(roads)
         m.save(file_path)
         return m
 
@@ -450,26 +837,361 @@ class Graph:
         Preconditions:
             - all(_id in self._vertices for _id in vertices_of_interest)
         """
-        output_file.write(weight_type + "\n")
-        output_file.write(" ".join([str(junc_id) for junc_id in vertices_of_interest]) + "\n")
-        output_file.write("|".join(list(pruned_classes)) + "\n")
-        output_file.write(f"V {len(self._vertices)}\n")
-        for junc_id in self._vertices:
-            output_file.write(str(junc_id) + "\n")
-            output_file.write(" ".join([str(c) for c in self._vertices[junc_id].coordinates]) + "\n")
+        output_file.writelines([weight_type + "\n",
+                                " ".join(map(str, vertices_of_interest)) + "\n",
+                                "|".join(pruned_classes) + "\n",
+                                f"V {len(self._vertices)}\n"])
+        output_file.writelines(f"{junc_id}\n{' '.join(map(str, vertex.coordinates.tolist()))}\n"
+                               for junc_id, vertex in self._vertices.items())
         output_file.write(f"E {len(self._edges)}\n")
-        for start_id, end_id in self._edges:
-            edge = self._edges[(start_id, end_id)]
-            output_file.write(f"e {start_id} {end_id}\n")
-            output_file.write(" ".join([str(ogfid) for ogfid in edge.ogf_ids]) + "\n")
-            output_file.write(f"d {edge.info["distance"]}\n")
-            output_file.write(f"t {edge.info["travel_time"]}\n")
+        for (start_id, end_id), edge in self._edges.items():
+            lines = [f"e {start_id} {end_id}\n",
+                     " ".join(map(str, edge.ogf_ids.tolist())) + "\n",
+                     f"d {edge.distance}\n",
+                     f"t {edge.travel_time}\n"]
             for segment in edge.segments:
-                output_file.write(f"S {segment.corr_ogfid}\n")
-                output_file.write(str(segment.seg_length) + "\n")
-                output_file.write(segment.road_class + "\n")
-                output_file.write(str(segment.speed_limit) + "\n")
-                locs = [f"{c[0]},{c[1]}" for c in segment.coordinates]
-                output_file.write(" ".join(locs) + "\n")
-                output_file.write(segment.name + "\n")
+                lines.append(f"S {segment.corr_ogfid}\n{segment.seg_length}\n{segment.road_class}\n"
+                             f"{segment.speed_limit}\n")
+                lines.append(" ".join([f"{lat},{lon}" for lat, lon in segment.coordinates.tolist()]) + "\n")
+                lines.append(segment.name + "\n")
+            output_file.writelines(lines)
         output_file.write("END")
+
+    def write_graph_npz(self, output_file: BinaryIO, weight_type: str, vertices_of_interest: list[int],
+                        pruned_classes: set[str], fingerprint: str = '') -> None:
+        """Write the graph to a compressed NumPy .npz archive, which loads much faster than the txt file
+        written by self.write_graph. fingerprint identifies the data the graph was built from (see
+        preprocessing.source_fingerprint), so that the archive can be discarded once the data changes.
+        The edges are stored in CSR form: the ogf ids and segments of the i-th edge are the entries from
+        edge_ogf_indptr[i] to edge_ogf_indptr[i + 1] of ogf_ids and from edge_seg_indptr[i] to
+        edge_seg_indptr[i + 1] of the seg_* arrays, and the coordinates of the j-th segment are the rows from
+        seg_coord_indptr[j] to seg_coord_indptr[j + 1] of seg_coords.
+
+        Preconditions:
+            - all(_id in self._vertices for _id in vertices_of_interest)
+        """
+        edges = list(self._edges.values())
+        segments = [segment for edge in edges for segment in edge.segments]
+        np.savez_compressed(
+            output_file,
+            version=np.array(NPZ_FORMAT_VERSION),
+            weight_type=np.array(weight_type),
+            source_fingerprint=np.array(fingerprint),
+            vertices_of_interest=np.array(vertices_of_interest, dtype=np.int64),
+            pruned_classes=np.array(sorted(pruned_classes), dtype=np.str_),
+            vertex_ids=np.fromiter(self._vertices, dtype=np.int64, count=len(self._vertices)),
+            vertex_coords=np.array([vertex.coordinates for vertex in self._vertices.values()],
+                                   dtype=np.float64).reshape(-1, 2),
+            edge_ends=np.array([(edge.start_id, edge.end_id) for edge in edges], dtype=np.int64).reshape(-1, 2),
+            edge_distance=np.array([edge.distance for edge in edges], dtype=np.float64),
+            edge_travel_time=np.array([edge.travel_time for edge in edges], dtype=np.float64),
+            edge_ogf_indptr=_offsets([len(edge.ogf_ids) for edge in edges]),
+            ogf_ids=np.concatenate([np.empty(0, dtype=np.int64)] + [edge.ogf_ids for edge in edges]),
+            edge_seg_indptr=_offsets([len(edge.segments) for edge in edges]),
+            seg_ogfid=np.array([segment.corr_ogfid for segment in segments], dtype=np.int64),
+            seg_length=np.array([segment.seg_length for segment in segments], dtype=np.float64),
+            seg_road_class=np.array([segment.road_class for segment in segments], dtype=np.str_),
+            seg_speed_limit=np.array([segment.speed_limit for segment in segments], dtype=np.int64),
+            seg_name=np.array([segment.name for segment in segments], dtype=np.str_),
+            seg_coord_indptr=_offsets([len(segment.coordinates) for segment in segments]),
+            seg_coords=np.concatenate([np.empty((0, 2))] + [segment.coordinates for segment in segments])
+        )
+
+
+class LazyPathMap(Mapping):
+    """A read-only mapping from the id of every vertex reachable from a source vertex to a shortest path from the
+    source to it and the weight of that path.
+    Each path is reconstructed from the predecessors found by Dijkstra's algorithm the first time it is looked up,
+    and every lookup returns a new copy of it.
+    """
+    _node_ids: list[int]
+    _node_iloc: dict[int, int]
+    _dist: list[float]
+    _prev: list[int]
+    _paths: dict[int, tuple[list[int], float]]
+
+    def __init__(self, node_ids: list[int], node_iloc: dict[int, int], dist: list[float], prev: list[int]) -> None:
+        self._node_ids = node_ids
+        self._node_iloc = node_iloc
+        self._dist = dist
+        self._prev = prev
+        self._paths = {}
+
+    def __getitem__(self, junc_id: int) -> tuple[list[int], float]:
+        if junc_id not in self._paths:
+            iloc = self._node_iloc.get(junc_id, -1)
+            if iloc == -1 or self._dist[iloc] == math.inf:
+                raise KeyError(junc_id)
+            self._paths[junc_id] = (_reconstruct_path(self._node_ids, self._prev, iloc), self._dist[iloc])
+        path, cost = self._paths[junc_id]
+        return list(path), cost
+
+    def __iter__(self) -> Iterator[int]:
+        return (self._node_ids[i] for i in range(len(self._dist)) if self._dist[i] < math.inf)
+
+    def __len__(self) -> int:
+        return sum(1 for d in self._dist if d < math.inf)
+
+
+def _dijkstra(indptr: list[int], neighbors: list[int], weights: list[float],
+              source: int, target: int) -> tuple[list[float], list[int]]:
+    """Run Dijkstra's algorithm from source over a graph in CSR form and stop once target is settled
+    (or once every vertex reachable from source is settled, if target is -1).
+    Return the lists dist and prev, where dist[v] is the tentative distance from source to v and prev[v] is the
+    vertex preceding v on that path (-1 if v has not been reached, or if v is source).
+
+    Preconditions:
+        - len(neighbors) == len(weights) == indptr[-1]
+        - all(w >= 0 for w in weights)
+        - 0 <= source < len(indptr) - 1 and -1 <= target < len(indptr) - 1
+        - source != target
+    """
+    n = len(indptr) - 1
+    dist = [math.inf] * n
+    prev = [-1] * n
+    visited = bytearray(n)
+    dist[source] = 0.0
+    q = [(0.0, source)]
+    while len(q) > 0:
+        du, u = heapq.heappop(q)
+        if visited[u]:
+            continue
+        visited[u] = True
+        if u == target:
+            break
+        for i in range(indptr[u], indptr[u + 1]):
+            v = neighbors[i]
+            cur_dist = du + weights[i]
+            if cur_dist < dist[v]:
+                dist[v] = cur_dist
+                prev[v] = u
+                heapq.heappush(q, (cur_dist, v))
+    return dist, prev
+
+
+def _astar(indptr: list[int], neighbors: list[int], weights: list[float], potential: list[float],
+           source: int, target: int) -> tuple[list[float], list[int]]:
+    """Run A* search from source to target over a graph in CSR form, using potential[v] as the estimated
+    distance from v to target, and stop once target is settled.
+    Return the lists dist and prev as described in _dijkstra.
+
+    Preconditions:
+        - len(neighbors) == len(weights) == indptr[-1]
+        - all(w >= 0 for w in weights)
+        - potential is consistent, i.e. potential[u] <= weights[i] + potential[neighbors[i]] for every edge i
+        leaving u, and potential[target] == 0
+        - 0 <= source < len(indptr) - 1 and 0 <= target < len(indptr) - 1
+        - source != target
+    """
+    n = len(indptr) - 1
+    dist = [math.inf] * n
+    prev = [-1] * n
+    visited = bytearray(n)
+    dist[source] = 0.0
+    q = [(potential[source], 0.0, source)]
+    while len(q) > 0:
+        _, du, u = heapq.heappop(q)
+        if visited[u]:
+            continue
+        visited[u] = True
+        if u == target:
+            break
+        for i in range(indptr[u], indptr[u + 1]):
+            v = neighbors[i]
+            cur_dist = du + weights[i]
+            if cur_dist < dist[v]:
+                dist[v] = cur_dist
+                prev[v] = u
+                heapq.heappush(q, (cur_dist + potential[v], cur_dist, v))
+    return dist, prev
+
+
+def _bidirectional_dijkstra(out_csr: tuple[list[int], list[int], list[float]],
+                            in_csr: tuple[list[int], list[int], list[float]],
+                            source: int, target: int) -> tuple[float, int, list[int], list[int]]:
+    """Run Dijkstra's algorithm forward from source over out_csr and backward from target over in_csr, always
+    advancing the search whose frontier is closer, until no path through an unsettled vertex can be shorter than
+    the best one found.
+    Return (best, meet, prev_f, prev_b), where best is the length of the shortest path, meet is a vertex on it
+    (-1 if target is unreachable), prev_f[v] is the vertex preceding v on the forward search tree and prev_b[v] is
+    the vertex following v on the backward search tree.
+
+    Preconditions:
+        - out_csr and in_csr are the (indptr, neighbors, weights) lists of the outgoing and incoming adjacency
+        of the same graph
+        - all weights are non-negative
+        - source != target
+    """
+    n = len(out_csr[0]) - 1
+    dists = ([math.inf] * n, [math.inf] * n)
+    prevs = ([-1] * n, [-1] * n)
+    visited = (bytearray(n), bytearray(n))
+    queues = ([(0.0, source)], [(0.0, target)])
+    dists[0][source] = 0.0
+    dists[1][target] = 0.0
+    best = math.inf
+    meet = -1
+    while len(queues[0]) > 0 and len(queues[1]) > 0 and queues[0][0][0] + queues[1][0][0] < best:
+        side = 0 if queues[0][0][0] <= queues[1][0][0] else 1
+        indptr, neighbors, weights = out_csr if side == 0 else in_csr
+        dist, prev, q = dists[side], prevs[side], queues[side]
+        other_dist = dists[1 - side]
+        du, u = heapq.heappop(q)
+        if visited[side][u]:
+            continue
+        visited[side][u] = True
+        for i in range(indptr[u], indptr[u + 1]):
+            v = neighbors[i]
+            cur_dist = du + weights[i]
+            if cur_dist < dist[v]:
+                dist[v] = cur_dist
+                prev[v] = u
+                heapq.heappush(q, (cur_dist, v))
+                if cur_dist + other_dist[v] < best:
+                    best = cur_dist + other_dist[v]
+                    meet = v
+    return best, meet, prevs[0], prevs[1]
+
+
+def _find(parent: list[int], u: int) -> int:
+    """Return the representative of the set containing u in the union-find forest parent, halving the path
+    from u to it along the way.
+    """
+    while parent[u] != u:
+        parent[u] = parent[parent[u]]
+        u = parent[u]
+    return u
+
+
+def _union(parent: list[int], rank: list[int], u: int, v: int) -> None:
+    """Merge the sets containing u and v in the union-find forest parent, using union by rank."""
+    root_u, root_v = _find(parent, u), _find(parent, v)
+    if root_u != root_v:
+        if rank[root_u] < rank[root_v]:
+            root_u, root_v = root_v, root_u
+        parent[root_v] = root_u
+        if rank[root_u] == rank[root_v]:
+            rank[root_u] += 1
+
+
+def _road_classes_mask(road_classes: set[str]) -> int:
+    """Return the road class mask with the bits of the road classes in road_classes set. Road classes that no
+    segment belongs to are ignored.
+    """
+    mask = 0
+    for road_class in road_classes:
+        mask |= _ROAD_CLASS_BITS.get(road_class, 0)
+    return mask
+
+
+def _link_kind(vertex: _Vertex, protected_ids: set[int]) -> int:
+    """Return 1 if vertex is an unprotected point on a one-way road, i.e. it has exactly one incoming and one outgoing
+    edge leading to different vertices, 2 if vertex is an unprotected point on a two-way road, i.e. it has exactly
+    two neighbours and edges in both directions between them, and 0 otherwise.
+    """
+    upstream, downstream = vertex.upstream, vertex.downstream
+    if vertex.junc_id in protected_ids:
+        return 0
+    elif len(upstream) == 1 and len(downstream) == 1 and upstream[0] is not downstream[0]:
+        return 1
+    elif len(upstream) == 2 and len(downstream) == 2 and set(upstream) == set(downstream):
+        return 2
+    else:
+        return 0
+
+
+def _chain_through(vertex: _Vertex, link_kind: int, protected_ids: set[int]) -> list[_Vertex]:
+    """Return the path [u, x_1, ..., x_k, w] along the road through vertex, where x_1, ..., x_k are the vertices
+    of kind link_kind on it (see _link_kind) and u and w are the first vertices of kind 0 on either side.
+    The path follows the direction of traffic if link_kind is 1.
+    If the chain closes into a cycle, return only vertex and its two neighbours, and if u is w, leave w out.
+
+    Preconditions:
+        - link_kind == _link_kind(vertex, protected_ids) != 0
+    """
+    if link_kind == 1:
+        before = _walk_chain(vertex, vertex.upstream[0], False, protected_ids)
+        after = _walk_chain(vertex, vertex.downstream[0], True, protected_ids)
+    else:
+        before = _walk_chain(vertex, vertex.downstream[0], True, protected_ids)
+        after = _walk_chain(vertex, vertex.downstream[1], True, protected_ids)
+    if before is None or after is None:
+        if link_kind == 1:
+            return [vertex.upstream[0], vertex, vertex.downstream[0]]
+        else:
+            return [vertex.downstream[0], vertex, vertex.downstream[1]]
+    path = before[::-1] + [vertex] + after
+    if path[0] is path[-1]:
+        path.pop()
+    return path
+
+
+def _walk_chain(vertex: _Vertex, neighbor: _Vertex, forward: bool, protected_ids: set[int]) -> Optional[list[_Vertex]]:
+    """Return the vertices met when walking away from vertex through its neighbour neighbor, up to and including the
+    first vertex that is not a point on a road (see _link_kind), following outgoing edges of one-way points if forward
+    and incoming edges otherwise. Return None if the walk comes back to vertex.
+    """
+    path = []
+    prev, cur = vertex, neighbor
+    while _link_kind(cur, protected_ids) != 0:
+        if cur is vertex:
+            return None
+        path.append(cur)
+        if len(cur.downstream) == 1:
+            prev, cur = cur, cur.downstream[0] if forward else cur.upstream[0]
+        else:
+            prev, cur = cur, cur.downstream[1] if cur.downstream[0] is prev else cur.downstream[0]
+    path.append(cur)
+    return path
+
+
+def _union_find_labels(n: int, src: list[int], dst: list[int]) -> list[int]:
+    """Return a list mapping each of the n vertices to the representative of its connected component in the
+    undirected graph with an edge between src[i] and dst[i] for every i, computed with union-find.
+    """
+    parent = list(range(n))
+    rank = [0] * n
+    for u, v in zip(src, dst):
+        _union(parent, rank, u, v)
+    return [_find(parent, u) for u in range(n)]
+
+
+def _group_by_label(node_ids: np.ndarray, labels: np.ndarray, min_size: int) -> list[set[int]]:
+    """Return the ids in node_ids grouped into sets by their entry in labels, ignoring negative labels
+    and groups with fewer than min_size ids.
+    """
+    labelled = labels >= 0
+    _, inverse, counts = np.unique(labels[labelled], return_inverse=True, return_counts=True)
+    order = np.argsort(inverse, kind='stable')
+    groups = np.split(node_ids[labelled][order], np.cumsum(counts)[:-1])
+    return [set(group.tolist()) for group in groups if len(group) >= min_size]
+
+
+def _reconstruct_path(node_ids: list[int], prev: list[int], target: int) -> list[int]:
+    """Return the ids of the vertices on the path to the vertex with iloc target, following the predecessor
+    list prev produced by _dijkstra back to the source.
+    """
+    path = []
+    cur = target
+    while cur != -1:
+        path.append(node_ids[cur])
+        cur = prev[cur]
+    path.reverse()
+    return path
+
+
+def _haversine(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Return the great-circle distances in metres between the [latitude, longitude] points (in degrees) along
+    the last axis of a and b, broadcasting a against b.
+    """
+    lat1, lon1 = np.radians(a[..., 0]), np.radians(a[..., 1])
+    lat2, lon2 = np.radians(b[..., 0]), np.radians(b[..., 1])
+    h = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * _EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(h, 1.0)))
+
+
+def _offsets(counts: list[int]) -> np.ndarray:
+    """Return the CSR offsets of consecutive groups with the given sizes, i.e. the array of length
+    len(counts) + 1 whose i-th entry is sum(counts[:i]).
+    """
+    return np.concatenate([np.zeros(1, dtype=np.int64), np.cumsum(np.array(counts, dtype=np.int64))])
@@ -1,8 +1,8 @@
 """The main module."""
 from typing import Optional, TextIO
-from preprocessing import data_to_graph, read_prebuilt_graph
+from concurrent.futures import Future, ThreadPoolExecutor
+from preprocessing import data_to_graph, read_prebuilt_graph_npz, source_fingerprint
 from graph_utils import Graph
-import folium
 import webbrowser
 import os
 
@@ -39,6 +39,21 @@ SELECTED_DESTINATIONS = {6295901: "Rideau Canal",
 
 PRUNED_CLASSES = {"Local / Street", "Local / Strata", "Local / Unknown"}
 
+ROAD_ELEMENTS_FILE = "data/ORN_Road_Elements.geojson"
+SEGMENTS_FILE = "data/ORN_Segments.geojson"
+
+
+def show_route(graph: Graph, route: list[int], file_name: str) -> None:
+    """Draw route on a map saved to file_name in the working directory and open it in the browser."""
+    graph.visualize_route(route, file_name)
+    webbrowser.open_new_tab("file:///" + os.getcwd() + "/" + file_name)
+
+
+def report_drawing_error(drawing: Future) -> None:
+    """Tell the user if the route drawn by drawing could not be drawn or opened."""
+    if drawing.exception() is not None:
+        print(f"Failed to draw route: {drawing.exception()!r}")
+
 
 if __name__ == "__main__":
     road_graph = None
@@ -48,19 +63,20 @@ if __name__ == "__main__":
         if weight_type not in {"distance", "travel_time", "q"}:
             print("Invalid input.")
     if weight_type != "q":
-        if os.path.exists(f"{weight_type}_weighted_graph.txt"):
+        fingerprint = source_fingerprint([ROAD_ELEMENTS_FILE, SEGMENTS_FILE])
+        if os.path.exists(f"{weight_type}_weighted_graph.npz"):
             print("Begin loading pre-pruned graph. This might take a while...")
-            with open(f"{weight_type}_weighted_graph.txt", "r") as graph_file:
-                road_graph = read_prebuilt_graph(graph_file, weight_type, SELECTED_DESTINATIONS, PRUNED_CLASSES)
+            with open(f"{weight_type}_weighted_graph.npz", "rb") as graph_file:
+                road_graph = read_prebuilt_graph_npz(graph_file, weight_type, SELECTED_DESTINATIONS, PRUNED_CLASSES,
+                                                     fingerprint)
             if road_graph is not None:
                 print(f"Finished loading pre-pruned graph. "
                       f"{road_graph.vertex_count()} vertices, {road_graph.edge_count()} directed edges.")
             else:
-                print("Graph configuration changed.")
-        if not os.path.exists(f"{weight_type}_weighted_graph.txt") or road_graph is None:
+                print("Graph configuration or data changed.")
+        if not os.path.exists(f"{weight_type}_weighted_graph.npz") or road_graph is None:
             print("Graph needs to be constructed from scratch.")
-            with open("data/ORN_Road_Elements.geojson", "r") as road_elem_data, \
-                    open("data/ORN_Segments.geojson", "r") as segment_data:
+            with open(ROAD_ELEMENTS_FILE, "r") as road_elem_data, open(SEGMENTS_FILE, "r") as segment_data:
                 print("Begin loading graph. This might take a while...")
                 road_graph = data_to_graph(road_elem_data, segment_data,
                                            weight_type, SELECTED_DESTINATIONS)
@@ -75,32 +91,44 @@ if __name__ == "__main__":
             print(f"Finished removing redundant vertices. "
                   f"{road_graph.vertex_count()} vertices, {road_graph.edge_count()} directed edges. "
                   f"Begin saving graph.")
-            with open(f"{weight_type}_weighted_graph.txt", "w") as output_file:
-                road_graph.write_graph(output_file, weight_type,
-                                       list(SELECTED_DESTINATIONS.keys()), PRUNED_CLASSES)
+            # Write to a temporary file first so that an interrupted save never leaves a truncated archive behind.
+            with open(f"{weight_type}_weighted_graph.npz.tmp", "wb") as output_file:
+                road_graph.write_graph_npz(output_file, weight_type,
+                                           list(SELECTED_DESTINATIONS.keys()), PRUNED_CLASSES, fingerprint)
+            os.replace(f"{weight_type}_weighted_graph.npz.tmp", f"{weight_type}_weighted_graph.npz")
             print("Finished saving graph.")
         road_graph.visualize_vertices(set(SELECTED_DESTINATIONS.keys()), "available_destinations.html")
         webbrowser.open_new_tab("file:///" + os.getcwd() + "/available_destinations.html")
         word = input("Enter 'q' to quit. Press enter to proceed to route planning: ")
         count = 0
-        while word != 'q':
-            start_id = int(input("Enter the id of the starting point: "))
-            end_id = int(input("Enter the id of the destination point: "))
-            if start_id in road_graph and end_id in road_graph:
-                count += 1
-                print("Begin planning route.")
-                res = road_graph.find_shortest_path(start_id, end_id, weight_type)
-                print("Finished planning route.")
-                if res is not None:
-                    path, cost = res
-                    road_graph.visualize_route(path, f"result_#{count}.html")
-                    webbrowser.open_new_tab("file:///" + os.getcwd() + f"/result_#{count}.html")
-                    if weight_type == "distance":
-                        print(f"The distance from the starting point to the destination is {round(cost / 1e3, 3)}km.")
+        # Routes are drawn in the background so that the next query can be entered while the map is written.
+        with ThreadPoolExecutor(max_workers=1) as drawer:
+            while word != 'q':
+                start_id = int(input("Enter the id of the starting point: "))
+                end_id = int(input("Enter the id of the destination point: "))
+                if start_id in road_graph and end_id in road_graph:
+                    count += 1
+                    print("Begin planning route.")
+                    if start_id in SELECTED_DESTINATIONS:
+                        # Routes from the destinations are planned often, so keep the shortest path tree of a
+                        # destination after the first query from it. Later queries from it only walk the tree.
+                        road_graph.precompute_shortest_paths([start_id], weight_type)
+                    # The great-circle bound on travel time assumes the fastest road everywhere, so it barely
+                    # guides A*; searching from both ends explores fewer vertices for such queries.
+                    res = road_graph.find_shortest_path(start_id, end_id, weight_type,
+                                                        "haversine" if weight_type == "distance" else "bidirectional")
+                    print("Finished planning route.")
+                    if res is not None:
+                        path, cost = res
+                        drawing = drawer.submit(show_route, road_graph, path, f"result_#{count}.html")
+                        drawing.add_done_callback(report_drawing_error)
+                        if weight_type == "distance":
+                            print(f"The distance from the starting point to the destination is "
+                                  f"{round(cost / 1e3, 3)}km.")
+                        else:
+                            print(f"The expected travel time is {round(cost, 3)} hours.")
                     else:
-                        print(f"The expected travel time is {round(cost, 3)} hours.")
+                        print("No route exist.")
                 else:
-                    print("No route exist.")
-            else:
-                print("Invalid input.")
-            word = input("Enter 'q' to quit. Press enter to proceed to the next route planning: ")
+                    print("Invalid input.")
+                word = input("Enter 'q' to quit. Press enter to proceed to the next route planning: ")
@@ -1,9 +1,12 @@
 """Improved version of preprocessing."""
-from typing import Optional, TextIO
+from typing import Any, BinaryIO, Iterator, Optional, TextIO
+import hashlib
 import json
 import math
-import folium
-from graph_utils import Graph
+import os
+import sys
+import numpy as np
+from graph_utils import Graph, NPZ_FORMAT_VERSION
 
 
 def data_to_graph(road_elem_data: TextIO, segment_data: TextIO,
@@ -13,53 +16,109 @@ def data_to_graph(road_elem_data: TextIO, segment_data: TextIO,
     Preconditions:
         - weight_type in {distance, travel_time}
     """
-    road_elements = json.load(road_elem_data)
-    road_segments = json.load(segment_data)
     graph = Graph()
-    id_to_segment_info = {}
-    for segment in road_segments["features"]:
-        road_segment_type = segment["properties"]["ROAD_ELEMENT_TYPE"]
-        speed_limit = segment["properties"]["SPEED_LIMIT"]
+    seg_ogfids, seg_lengths, seg_road_classes, seg_speed_limits, seg_coords, seg_names = [], [], [], [], [], []
+    for segment in _iter_features(segment_data):
+        properties = segment["properties"]
+        road_segment_type = properties["ROAD_ELEMENT_TYPE"]
+        speed_limit = properties["SPEED_LIMIT"]
         if road_segment_type != "VIRTUAL ROAD" and (road_segment_type == "FERRY CONNECTION" or speed_limit is not None):
-            if speed_limit is None:
-                speed_limit = 34
-            ogfid = segment["properties"]["ROAD_NET_ELEMENT_ID"]
-            name = segment["properties"]["FULL_STREET_NAME"]
-            if name is None:
-                name = ''
-            length = segment["properties"]["LENGTH"]
-            road_class = segment["properties"]["ROAD_CLASS"]
-            coords = segment["geometry"]["coordinates"]
-            if all(len(c) == 2 and isinstance(c[0], int | float) and isinstance(c[1], int | float) for c in coords):
-                for c in coords:
-                    c.reverse()
-                if ogfid not in id_to_segment_info:
-                    id_to_segment_info[ogfid] = [(ogfid, length, road_class, speed_limit, coords, name)]
-                else:
-                    id_to_segment_info[ogfid].append((ogfid, length, road_class, speed_limit, coords, name))
-    for road_elem in road_elements["features"]:
-        ogfid = road_elem["properties"]["OGF_ID"]
-        from_id = road_elem["properties"]["FROM_JUNCTION_ID"]
-        to_id = road_elem["properties"]["TO_JUNCTION_ID"]
-        from_coord = road_elem["geometry"]["coordinates"][0]
-        to_coord = road_elem["geometry"]["coordinates"][-1]
-        if ogfid in id_to_segment_info and from_id != to_id \
-                and all(isinstance(c, int | float) for c in from_coord) and \
-                all(isinstance(c, int | float) for c in to_coord):
-            from_coord.reverse()
-            to_coord.reverse()
-            graph.add_vertex(from_id, from_coord)
-            graph.add_vertex(to_id, to_coord)
-            length = road_elem["properties"]["LENGTH"]
-            direction = road_elem["properties"]["DIRECTION_OF_TRAFFIC_FLOW"]
-            if direction in {"Both", "Positive"}:
-                graph.add_edge_with_segments(from_id, to_id, {ogfid}, length, weight_type, id_to_segment_info[ogfid])
-            if direction in {"Both", "Negative"}:
-                graph.add_edge_with_segments(to_id, from_id, {ogfid}, length, weight_type, id_to_segment_info[ogfid])
+            ogfid = properties["ROAD_NET_ELEMENT_ID"]
+            # Road classes and street names repeat across many segments, so share one string object for each.
+            name = properties["FULL_STREET_NAME"]
+            name = '' if name is None else sys.intern(name)
+            length = properties["LENGTH"]
+            road_class = sys.intern(properties["ROAD_CLASS"])
+            coords = _to_float_array(segment["geometry"]["coordinates"])
+            # Keep the segment only if it is a list of (lon, lat) pairs, or has no points at all.
+            if coords is not None and (coords.ndim == 2 and coords.shape[1] == 2
+                                       or coords.ndim == 1 and coords.size == 0):
+                # Swap (lon, lat) into (lat, lon) in one copy rather than reversing every point.
+                coords = np.ascontiguousarray(coords.reshape(-1, 2)[:, ::-1])
+                seg_ogfids.append(ogfid)
+                seg_lengths.append(length)
+                seg_road_classes.append(road_class)
+                seg_speed_limits.append(speed_limit)
+                seg_coords.append(coords)
+                seg_names.append(name)
+    # Sort the segment table by road element, so that the segments of the i-th road element are the rows bounds[i] to
+    # bounds[i + 1] of every column, in the order they appear in the data. element_index maps ogf ids to i.
+    order = np.argsort(np.array(seg_ogfids, dtype=np.int64), kind="stable")
+    seg_ogfids = np.array(seg_ogfids, dtype=np.int64)[order]
+    seg_lengths = np.array(seg_lengths, dtype=np.float64)[order]
+    # Missing speed limits (only kept for ferry connections) convert to nan and default to 34km/h.
+    speed_limits = np.array(seg_speed_limits, dtype=np.float64)[order]
+    speed_limits[np.isnan(speed_limits)] = 34
+    seg_speed_limits = [34 if seg_speed_limits[i] is None else seg_speed_limits[i] for i in order.tolist()]
+    seg_road_classes = [seg_road_classes[i] for i in order.tolist()]
+    seg_coords = [seg_coords[i] for i in order.tolist()]
+    seg_names = [seg_names[i] for i in order.tolist()]
+    is_first = np.concatenate([np.ones(min(len(seg_ogfids), 1), dtype=bool), seg_ogfids[1:] != seg_ogfids[:-1]])
+    bounds = np.append(np.flatnonzero(is_first), len(seg_ogfids)).tolist()
+    element_index = {ogfid: i for i, ogfid in enumerate(seg_ogfids[is_first].tolist())}
+    # Sum the travel times of the segments of every road element in one pass.
+    seg_times = seg_lengths / (speed_limits * 1e3)
+    element_travel_times = np.bincount(np.cumsum(is_first) - 1, weights=seg_times,
+                                       minlength=len(element_index)).tolist()
+    # Collect the junctions and road elements first, so that all vertices are added to the graph at once.
+    junction_coords = {}
+    road_elems = []
+    for road_elem in _iter_features(road_elem_data):
+        properties = road_elem["properties"]
+        ogfid = properties["OGF_ID"]
+        from_id = properties["FROM_JUNCTION_ID"]
+        to_id = properties["TO_JUNCTION_ID"]
+        coords = road_elem["geometry"]["coordinates"]
+        from_coord = _to_float_array(coords[0])
+        to_coord = _to_float_array(coords[-1])
+        # Junctions may carry a third (elevation) component after their (lon, lat), which is ignored.
+        if ogfid in element_index and from_id != to_id and from_coord is not None and to_coord is not None \
+                and from_coord.ndim == to_coord.ndim == 1 and from_coord.size >= 2 and to_coord.size >= 2:
+            junction_coords.setdefault(from_id, from_coord[1::-1])
+            junction_coords.setdefault(to_id, to_coord[1::-1])
+            road_elems.append((ogfid, from_id, to_id, properties["LENGTH"], properties["DIRECTION_OF_TRAFFIC_FLOW"]))
+    graph.add_vertices(junction_coords)
+    for ogfid, from_id, to_id, length, direction in road_elems:
+        i = element_index[ogfid]
+        start, end = bounds[i], bounds[i + 1]
+        segment_columns = (seg_ogfids[start:end], seg_lengths[start:end], seg_road_classes[start:end],
+                           seg_speed_limits[start:end], seg_coords[start:end], seg_names[start:end])
+        if direction in {"Both", "Positive"}:
+            graph.add_edge_with_segment_arrays(from_id, to_id, {ogfid}, length, weight_type, *segment_columns,
+                                               element_travel_times[i], direction == "Both")
+        elif direction == "Negative":
+            graph.add_edge_with_segment_arrays(to_id, from_id, {ogfid}, length, weight_type, *segment_columns,
+                                               element_travel_times[i])
     graph.add_message_to_vertices(vertices_of_interest)
     return graph
 
 
+def _to_float_array(values: Any) -> Optional[np.ndarray]:
+    """Return values converted to a float64 array, or None if values are not all numbers (e.g. if some of them
+    are strings or null, or the nested lists have different lengths).
+    """
+    try:
+        arr = np.array(values)
+    except (TypeError, ValueError):
+        return None
+    # Strings, nulls and ragged lists give arrays of strings or objects instead of booleans or numbers.
+    return arr.astype(np.float64) if arr.dtype.kind in "biuf" else None
+
+
+def source_fingerprint(paths: list[str]) -> str:
+    """Return a fingerprint of the files at paths that changes whenever one of them is modified.
+    The fingerprint is computed from the sizes and modification times of the files rather than their contents,
+    so that it is cheap even for large data files. Return '' if some file does not exist.
+    """
+    digest = hashlib.sha256()
+    for path in paths:
+        if not os.path.exists(path):
+            return ''
+        stat = os.stat(path)
+        digest.update(f"{path}|{stat.st_size}|{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
 def read_prebuilt_graph(graph_file: TextIO, weight_type: str,
                         vertices_of_interest: dict[int, str], pruned_classes: set[str]) -> Optional[Graph]:
     """Read a prebuilt graph from a txt file.
@@ -121,3 +180,133 @@ def read_prebuilt_graph(graph_file: TextIO, weight_type: str,
             assert math.isclose(time, graph.get_weight(start_id, end_id, "travel_time"), abs_tol=1e-3)
         assert line[0] == "END"
         return graph
+
+
+def read_prebuilt_graph_npz(graph_file: BinaryIO, weight_type: str, vertices_of_interest: dict[int, str],
+                            pruned_classes: set[str], fingerprint: str = '') -> Optional[Graph]:
+    """Read a prebuilt graph from an npz archive written by Graph.write_graph_npz.
+    Return None if the archive was written in another format version, or if weight_type or vertices_of_interest is
+    inconsistent with the pre-stored weight_type or vertices_of_interest, or if fingerprint is not '' and
+    differs from the fingerprint (see source_fingerprint) of the data the graph was built from.
+    """
+    with np.load(graph_file) as data:
+        if "version" not in data or int(data["version"]) != NPZ_FORMAT_VERSION or \
+                str(data["weight_type"]) != weight_type or \
+                fingerprint not in {'', str(data["source_fingerprint"])} or \
+                set(data["vertices_of_interest"].tolist()) != set(vertices_of_interest.keys()) or \
+                set(data["pruned_classes"].tolist()) != pruned_classes:
+            return None
+        graph = Graph()
+        for cur_id, coord in zip(data["vertex_ids"].tolist(), data["vertex_coords"].tolist()):
+            graph.add_vertex(cur_id, coord, vertices_of_interest.get(cur_id, ''))
+        coords = data["seg_coords"]
+        coord_indptr = data["seg_coord_indptr"].tolist()
+        seg_coords = [coords[coord_indptr[j]:coord_indptr[j + 1]] for j in range(len(coord_indptr) - 1)]
+        seg_ogfids = data["seg_ogfid"]
+        seg_lengths = data["seg_length"]
+        seg_road_classes = list(map(sys.intern, data["seg_road_class"].tolist()))
+        seg_speed_limits = data["seg_speed_limit"].tolist()
+        seg_names = list(map(sys.intern, data["seg_name"].tolist()))
+        ogf_ids = data["ogf_ids"].tolist()
+        ogf_indptr = data["edge_ogf_indptr"].tolist()
+        seg_indptr = data["edge_seg_indptr"].tolist()
+        distances = data["edge_distance"].tolist()
+        travel_times = data["edge_travel_time"].tolist()
+        for i, (start_id, end_id) in enumerate(data["edge_ends"].tolist()):
+            start, end = seg_indptr[i], seg_indptr[i + 1]
+            graph.add_edge_with_segment_arrays(start_id, end_id, set(ogf_ids[ogf_indptr[i]:ogf_indptr[i + 1]]),
+                                               distances[i], weight_type, seg_ogfids[start:end],
+                                               seg_lengths[start:end], seg_road_classes[start:end],
+                                               seg_speed_limits[start:end], seg_coords[start:end],
+                                               seg_names[start:end], travel_times[i])
+        return graph
+
+
+def _iter_features(geojson: TextIO, chunk_size: int = 1 << 20) -> Iterator[dict]:
+    """Yield the features of the GeoJSON FeatureCollection in geojson one at a time, decoding the file
+    chunk_size characters at a time instead of loading the whole collection into memory.
+    Raise ValueError if geojson is not a JSON object with a "features" array.
+    """
+    stream = _JSONStream(geojson, chunk_size)
+    stream.expect("{")
+    while stream.next_char() != "}":
+        key = stream.decode()
+        stream.expect(":")
+        if key == "features":
+            stream.expect("[")
+            while stream.next_char() != "]":
+                yield stream.decode()
+                if stream.next_char() == ",":
+                    stream.expect(",")
+            stream.expect("]")
+        else:
+            stream.decode()
+        if stream.next_char() == ",":
+            stream.expect(",")
+
+
+_JSON_DELIMITERS = " \t\n\r,:]}"  # The characters that may follow a complete JSON value.
+
+
+class _JSONStream:
+    """A reader of consecutive JSON values from a text file that only keeps the part of the file that has
+    been read but not decoded yet in memory.
+    """
+    _file: TextIO
+    _chunk_size: int
+    _decoder: json.JSONDecoder
+    _buffer: str
+    _pos: int
+    _eof: bool
+
+    def __init__(self, file: TextIO, chunk_size: int = 1 << 20) -> None:
+        self._file = file
+        self._chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+
+    def _read_more(self) -> bool:
+        """Append the next chunk of the file to the buffer, dropping the decoded part.
+        Return whether anything was read.
+        """
+        chunk = '' if self._eof else self._file.read(self._chunk_size)
+        if chunk == '':
+            self._eof = True
+            return False
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def next_char(self) -> str:
+        """Skip whitespace and return the next character without consuming it, or '' at the end of the file."""
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in " \t\n\r":
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            elif not self._read_more():
+                return ''
+
+    def expect(self, char: str) -> None:
+        """Consume the next non-whitespace character. Raise ValueError if it is not char."""
+        if self.next_char() != char:
+            raise ValueError
+        self._pos += 1
+
+    def decode(self) -> Any:
+        """Decode and consume the next JSON value. Raise ValueError if it is malformed or incomplete."""
+        self.next_char()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if not self._read_more():
+                    raise ValueError
+            else:
+                # A number cut off by the end of the buffer decodes as a shorter number (e.g. "2." as 2), so a
+                # value is only accepted once a character that cannot continue it, or the end of the file, follows.
+                if (end < len(self._buffer) and self._buffer[end] in _JSON_DELIMITERS) or not self._read_more():
+                    self._pos = end
+                    return value
@@ -0,0 +1,79 @@
+"""Tests for preprocessing."""
+import io
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from graph_utils import Graph  # noqa: E402
+from preprocessing import _JSONStream, _iter_features, _to_float_array, data_to_graph  # noqa: E402
+
+DOCUMENT = json.dumps({
+    "type": "FeatureCollection",
+    "name": "test",
+    "features": [1, 2.25, -0.5, 1.5e-7, 12345678901234567890, 3E+2, "a \" b", True, False, None, [],
+                 {"properties": {"LENGTH": 376.4168932632768, "NAME": "KING ST"},
+                  "geometry": {"coordinates": [[-78.99817586291245, 43.00179130994824]]}}],
+    "crs": {"type": "name"}
+})
+
+
+def test_iter_features_every_chunk_size() -> None:
+    """The features decoded do not depend on where the chunk boundaries fall."""
+    expected = json.loads(DOCUMENT)["features"]
+    for chunk_size in range(1, len(DOCUMENT) + 2):
+        assert list(_iter_features(io.StringIO(DOCUMENT), chunk_size)) == expected, chunk_size
+
+
+def test_decode_number_split_at_chunk_boundary() -> None:
+    """A number whose prefix is itself a number is not cut off at a chunk boundary."""
+    for document in ['{"features":[1,2.25]}', '[1.5e-7]', '-12.5E+3']:
+        for chunk_size in range(1, len(document) + 2):
+            assert _JSONStream(io.StringIO(document), chunk_size).decode() == json.loads(document), chunk_size
+
+
+def test_to_float_array_rejects_non_numbers() -> None:
+    """Strings, nulls and ragged coordinate lists are rejected like in the original isinstance check."""
+    for values in [["1.5", "2"], [1, "a"], [1, None], [[1, 2], [3]], [[1, None]]]:
+        assert _to_float_array(values) is None, values
+    assert _to_float_array([True, 2]).tolist() == [1.0, 2.0]
+    assert _to_float_array([[1, 2], [3.5, 4]]).shape == (2, 2)
+
+
+def _one_road_graph(segment_coords: list, junction_coords: list) -> Graph:
+    """Return the graph built from a single road element between junctions 1 and 2 and a single segment of it."""
+    segments = {"features": [{
+        "properties": {"ROAD_ELEMENT_TYPE": "ROAD ELEMENT", "SPEED_LIMIT": 50, "ROAD_NET_ELEMENT_ID": 7,
+                       "FULL_STREET_NAME": "KING ST", "LENGTH": 100.0, "ROAD_CLASS": "Local / Street"},
+        "geometry": {"coordinates": segment_coords}}]}
+    road_elements = {"features": [{
+        "properties": {"OGF_ID": 7, "FROM_JUNCTION_ID": 1, "TO_JUNCTION_ID": 2, "LENGTH": 100.0,
+                       "DIRECTION_OF_TRAFFIC_FLOW": "Both"},
+        "geometry": {"coordinates": junction_coords}}]}
+    return data_to_graph(io.StringIO(json.dumps(road_elements)), io.StringIO(json.dumps(segments)), "distance", {})
+
+
+def test_data_to_graph_segment_coordinates() -> None:
+    """Segments are kept only if they are lists of (lon, lat) pairs or have no points, like in the original check."""
+    junctions = [[-79.0, 43.0], [-79.1, 43.1]]
+    for segment_coords in [[[-79.0, 43.0], [-79.1, 43.1]], []]:
+        assert _one_road_graph(segment_coords, junctions).edge_count() == 2, segment_coords
+    for segment_coords in [[[]], [[], []], [[-79.0, 43.0, 80.0]], [[-79.0, "43.0"]], [[-79.0, None]]]:
+        assert _one_road_graph(segment_coords, junctions).edge_count() == 0, segment_coords
+
+
+def test_data_to_graph_junction_coordinates() -> None:
+    """Junctions with an elevation after their (lon, lat) are kept, and junctions with fewer components are not."""
+    segment = [[-79.0, 43.0], [-79.1, 43.1]]
+    graph = _one_road_graph(segment, [[-79.0, 43.0, 80.5], [-79.1, 43.1, 81.0]])
+    assert graph.edge_count() == 2
+    assert graph.get_vertex_coordinates(1).tolist() == [43.0, -79.0]
+    assert graph.get_vertex_coordinates(2).tolist() == [43.1, -79.1]
+    for junctions in [[[-79.0], [-79.1, 43.1]], [[], [-79.1, 43.1]], [[-79.0, None], [-79.1, 43.1]]]:
+        assert _one_road_graph(segment, junctions).edge_count() == 0, junctions
+
+
+if __name__ == "__main__":
+    import pytest
+    pytest.main([__file__])